@@ -30,9 +30,11 @@ class CommandTracker(type):
 
 class Command(metaclass=CommandTracker):
     @classmethod
-    def add_subparsers(cls, parser):
+    def add_subparsers(cls, parser, only=None):
         subparsers = parser.add_subparsers(title="commands")
         for c in cls._commands:
+            if only is not None and c.command not in only:
+                continue
             description = c.description if hasattr(c, "description") \
                 else c.__doc__
             help = c.help if hasattr(c, "help") else description
@@ -57,8 +59,10 @@ class ListGear(Command):
     @staticmethod
     def run(args):
         for sitename, site in report.sites.items():
-            for gear in site.gear:
-                print(f"{sitename}/{gear.busname}/{gear.address}: {gear.name}")
+            # Work from the raw configuration so no Gear or Bus
+            # objects need to be built
+            for g in site._raw_gear:
+                print(f"{sitename}/{g['bus']}/{g['address']}: {g['name']}")
 
 
 class Scan(Command):
@@ -112,11 +116,11 @@ class Check(Command):
                 print("  - Gear:")
 
                 def progress(gear):
-                    print(f"    - {sitename}/{gear.busname}/{gear.address} — "
-                          f"{gear.summary}")
+                    print(f"    - {gear.qualname} — {gear.summary}")
                     gear.dump_state(indent=8)
 
-            site.update(progress=progress if args.verbose else None)
+            site.update(progress=progress if args.verbose else None,
+                        rescan=args.rescan)
 
             print(f"  - Overall state: {'Pass' if site.pass_ else 'Fail'}")
             print(f"  - Results: {site.results}")
@@ -135,20 +139,36 @@ class Email(Command):
 
     @staticmethod
     def run(args):
-        for sitename, site in report.sites.items():
-            if args.verbose:
-                print(f"Site: {site.name}")
-
-            def progress(gear):
+        import smtplib
+        failed = False
+        with smtplib.SMTP() as smtp:
+            smtp.connect()
+            for sitename, site in report.sites.items():
                 if args.verbose:
-                    print(f"  - {sitename}/{gear.busname}/{gear.address} — "
-                          f"{gear.summary}")
+                    print(f"Site: {site.name}")
 
-            site.update(progress=progress)
-            if args.destination:
-                site.email_report(sitename, to=args.destination)
-            else:
-                site.email_report(sitename)
+                def progress(gear):
+                    if args.verbose:
+                        print(f"  - {gear.qualname} — {gear.summary}")
+
+                site.update(progress=progress, rescan=args.rescan)
+                try:
+                    try:
+                        site.email_report(sitename, to=args.destination,
+                                          smtp=smtp)
+                    except smtplib.SMTPServerDisconnected:
+                        # The connection sits idle while a site is
+                        # being polled and the server may drop it;
+                        # reconnect and retry once
+                        smtp.connect()
+                        site.email_report(sitename, to=args.destination,
+                                          smtp=smtp)
+                except smtplib.SMTPException as e:
+                    print(f"emcon: error: could not send report for "
+                          f"site {sitename}: {e}")
+                    failed = True
+        if failed:
+            return 1
 
 
 class UpdateFunctionTestInterval(Command):
@@ -169,8 +189,8 @@ class UpdateFunctionTestInterval(Command):
             print("*** DRY RUN MODE — changes will not be committed ***")
         for sitename, site in report.sites.items():
             for gear in site.gear:
-                idx = f"{sitename}/{gear.bus.key}/{gear.address}: {gear.name}"
-                gear.update()
+                idx = f"{gear.qualname}: {gear.name}"
+                gear.update(rescan=args.rescan)
                 if not gear.is_emergency:
                     print(f"{idx}: **NOT PRESENT** — skipping")
                     continue
@@ -307,7 +327,22 @@ def main():
     parser.add_argument(
         '--verbose', '-v', action="store_true", default=False,
         help="Display progress while working")
-    Command.add_subparsers(parser)
+    parser.add_argument(
+        '--rescan', action="store_true", default=False,
+        help="Re-probe device types instead of using the cached "
+        "results; use after adding or replacing gear")
+
+    # Constructing an argparse subparser for every command dominates
+    # cold start.  If exactly one known command name appears on the
+    # command line, only build that one; help output and ambiguous
+    # command lines still get the full set.
+    mentioned = {c.command for c in Command._commands}\
+        .intersection(sys.argv[1:])
+    if len(mentioned) == 1 \
+       and not {"-h", "--help"}.intersection(sys.argv[1:]):
+        Command.add_subparsers(parser, only=mentioned)
+    else:
+        Command.add_subparsers(parser)
 
     args = parser.parse_args()
 
@@ -319,10 +354,13 @@ def main():
         sys.exit(1)
 
     if args.site:
-        try:
-            report.sites = {s: report.sites[s] for s in args.site}
-        except KeyError as e:
-            print(f"Unrecognised site '{e.args[0]}'")
-            sys.exit(1)
+        for s in args.site:
+            if s not in report.sites:
+                print(f"Unrecognised site '{s}'")
+                sys.exit(1)
+        selected = set(args.site)
+        for s in list(report.sites):
+            if s not in selected:
+                del report.sites[s]
 
     sys.exit(args.command.run(args))
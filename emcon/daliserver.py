@@ -60,6 +60,8 @@ class DaliServer:
                 elif isinstance(cmd, seq_progress):
                     if progress:
                         progress(cmd)
+                elif isinstance(cmd, (list, tuple)):
+                    response = self._send_many(s, cmd)
                 else:
                     if cmd.devicetype != 0:
                         self._send(s, EnableDeviceType(cmd.devicetype))
@@ -82,6 +84,57 @@ class DaliServer:
             s.send(message)
             result = s.recv(4)
 
+        return self._decode(command, result)
+
+    def _send_many(self, s, commands):
+        """Send several commands in a single burst
+
+        Writes all the forward frames before reading any of the
+        replies, so the whole exchange costs roughly one network
+        round-trip instead of one per frame.  daliserver sends one
+        4-byte reply per frame.  Returns a list of responses, one
+        per command.
+        """
+        message = b""
+        nframes = []
+        for command in commands:
+            cmds = [command]
+            if command.devicetype != 0:
+                cmds.insert(0, EnableDeviceType(command.devicetype))
+            n = 0
+            for cmd in cmds:
+                f = cmd.frame
+                if len(f) != 16:
+                    raise UnsupportedFrameTypeError
+                packed = struct.pack("BB", 2, 0) + f.pack
+                message += packed
+                n += 1
+                if cmd.sendtwice:
+                    message += packed
+                    n += 1
+            nframes.append(n)
+        s.sendall(message)
+
+        expected = sum(nframes) * 4
+        replies = b""
+        while len(replies) < expected:
+            chunk = s.recv(expected - len(replies))
+            if not chunk:
+                raise CommunicationError(
+                    "connection closed during batch send")
+            replies += chunk
+
+        # The reply to a command is the reply to the last frame sent
+        # for it; replies to EnableDeviceType and repeated frames are
+        # discarded.
+        responses = []
+        offset = 0
+        for command, n in zip(commands, nframes):
+            offset += n * 4
+            responses.append(self._decode(command, replies[offset - 4:offset]))
+        return responses
+
+    def _decode(self, command, result):
         ver, status, rval, pad = struct.unpack("BBBB", result)
         response = None
 
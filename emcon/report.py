@@ -1,11 +1,11 @@
-import tomli
 from enum import Enum
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
 import datetime
-import jinja2
-import smtplib
-from email.message import EmailMessage
-from html2text import html2text
+import json
+import pathlib
+import threading
 from dali.address import GearShort
 from dali.gear.general import (
     QueryControlGearPresent,
@@ -31,6 +31,62 @@ from .daliserver import DaliServer
 
 sites = {}
 
+_jinja_env = None
+_template_cache = {}
+
+
+_devtype_cache_file = pathlib.Path(
+    "~/.cache/emcon/devtypes.json").expanduser()
+_devtype_cache = None
+_devtype_lock = threading.Lock()
+
+
+def _load_devtype_cache():
+    """Persistent memo of which units are emergency gear
+
+    Keyed by (hostname, port, address).  Whether a unit is emergency
+    gear is a fixed hardware property, so it only needs re-probing
+    when gear is replaced.
+    """
+    global _devtype_cache
+    if _devtype_cache is None:
+        _devtype_cache = {}
+        try:
+            with open(_devtype_cache_file) as f:
+                for key, is_emergency in json.load(f).items():
+                    hostname, port, address = key.rsplit(":", 2)
+                    _devtype_cache[(hostname, int(port), int(address))] \
+                        = is_emergency
+        except (OSError, ValueError):
+            pass
+    return _devtype_cache
+
+
+def _save_devtype_cache():
+    try:
+        _devtype_cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(_devtype_cache_file, "w") as f:
+            json.dump({f"{hostname}:{port}:{address}": is_emergency
+                       for (hostname, port, address), is_emergency
+                       in _devtype_cache.items()}, f)
+    except OSError:
+        pass
+
+
+def _get_template(name):
+    """Fetch a template, building the jinja2 environment on first use"""
+    global _jinja_env
+    template = _template_cache.get(name)
+    if template is None:
+        if _jinja_env is None:
+            import jinja2
+            _jinja_env = jinja2.Environment(
+                loader=jinja2.PackageLoader("emcon"),
+                autoescape=jinja2.select_autoescape(),
+                auto_reload=False)
+        template = _template_cache[name] = _jinja_env.get_template(name)
+    return template
+
 
 class EmergencyMode(Enum):
     NORMAL = "Normal"
@@ -53,6 +109,11 @@ emergency_mode_values = {
     0x20: EmergencyMode.DURATION_TEST,
 }
 
+# The same mapping as a table indexed directly by the 6-bit field;
+# anything other than a single set bit is invalid
+_mode_table = tuple(
+    emergency_mode_values.get(i, EmergencyMode.INVALID) for i in range(64))
+
 
 class TestStatus(Enum):
     NOT_TESTED = "not done"
@@ -73,8 +134,14 @@ class NextTestStatus(Enum):
 
 passing_next_test_status = {NextTestStatus.SCHEDULED, NextTestStatus.PENDING}
 
+# Summary for passing gear; a sentinel so passing can be checked by
+# identity rather than string comparison
+_PASS = "Pass"
+
 
 class Bus:
+    __slots__ = ('key', 'site', 'hostname', 'port', 'name', '_ds')
+
     def __init__(self, d, key, site):
         self.key = key
         self.site = site
@@ -95,12 +162,25 @@ class Bus:
 
 
 class Gear:
+    __slots__ = (
+        'site', 'busname', 'bus', 'address', 'name', 'qualname',
+        'expected_rated_duration', 'expected_ft_interval',
+        'expected_dt_interval', 'expected_timeout',
+        '_summary', '_summary_ts', 'timestamp', 'present', 'mode',
+        'is_emergency', 'rated_duration', 'circuit_failure',
+        'battery_duration_failure', 'battery_failure',
+        'emergency_lamp_failure', 'battery_charge', 'ft_state',
+        'dt_state', 'dt_result', 'next_ft_state', 'next_dt_state',
+        'ft_interval', 'dt_interval', 'timeout', 'ft_delay', 'dt_delay',
+    )
+
     def __init__(self, site, d):
         self.site = site
         self.busname = d["bus"]
         self.bus = site.buses[d["bus"]]
         self.address = d["address"]
         self.name = d["name"]
+        self.qualname = f"{site.key}/{self.busname}/{self.address}"
         self.expected_rated_duration = d.get(
             "rated-duration", site.expected_rated_duration)
         self.expected_ft_interval = d.get(
@@ -113,6 +193,7 @@ class Gear:
 
     def clear(self):
         self._summary = None
+        self._summary_ts = None  # Timestamp the summary was computed for
         self.timestamp = None  # Time gear information was read
         self.present = False
         self.mode = EmergencyMode.INVALID
@@ -159,8 +240,9 @@ class Gear:
 
     @property
     def summary(self):
-        if not self._summary:
+        if self._summary is None or self._summary_ts is not self.timestamp:
             self._summary = self._update_summary()
+            self._summary_ts = self.timestamp
         return self._summary
 
     def _update_summary(self):
@@ -194,11 +276,11 @@ class Gear:
         if self.dt_state not in passing_test_status \
            and self.next_dt_state != NextTestStatus.PENDING:
             return f"Duration test {self.dt_state.value}"
-        return "Pass"
+        return _PASS
 
     @property
     def pass_(self):
-        return self.summary == "Pass"
+        return self.summary is _PASS
 
     def dump_state(self, indent=0):
         for line in self.list_state():
@@ -256,13 +338,17 @@ class Gear:
             p(f"Next duration test: {self.next_dt_state.value}")
         return r
 
-    def update(self):
+    def update(self, rescan=False):
+        with self.bus as b:
+            self._update_on(b, rescan=rescan)
+
+    def _update_on(self, b, rescan=False):
+        """Read gear state using an already-open bus connection"""
         self.clear()
         self.timestamp = datetime.datetime.now()
-        with self.bus as b:
-            b.send(self._read())
+        b.send(self._read(rescan=rescan))
 
-    def _read(self):
+    def _read(self, rescan=False):
         a = GearShort(self.address)
 
         r = yield QueryControlGearPresent(a)
@@ -270,8 +356,19 @@ class Gear:
             return
         self.present = True
 
-        devicetypes = yield from QueryDeviceTypes(a)
-        if 1 not in devicetypes:
+        # The (multi-frame) device type probe is cached persistently
+        # and only repeated on --rescan
+        key = (self.bus.hostname, self.bus.port, self.address)
+        with _devtype_lock:
+            cache = _load_devtype_cache()
+            is_emergency = None if rescan else cache.get(key)
+        if is_emergency is None:
+            devicetypes = yield from QueryDeviceTypes(a)
+            is_emergency = 1 in devicetypes
+            with _devtype_lock:
+                cache[key] = is_emergency
+                _save_devtype_cache()
+        if not is_emergency:
             return
         self.is_emergency = True
 
@@ -286,8 +383,7 @@ class Gear:
         self.battery_failure = fs.battery_failure
         self.emergency_lamp_failure = fs.emergency_lamp_failure
 
-        self.mode = emergency_mode_values.get(
-            mode.raw_value[5:0], EmergencyMode.INVALID)
+        self.mode = _mode_table[mode.raw_value[5:0]]
 
         if self.mode == EmergencyMode.NORMAL and es.inhibit_mode:
             self.mode = EmergencyMode.INHIBIT
@@ -321,20 +417,25 @@ class Gear:
                     if fs.duration_test_max_delay_exceeded \
                        else NextTestStatus.PENDING
 
-            yield DTR0(4)  # function test interval
-            self.ft_interval = (yield QueryTestTiming(a)).raw_value.as_integer
-            yield DTR0(5)  # duration test interval
-            self.dt_interval = (yield QueryTestTiming(a)).raw_value.as_integer
-            yield DTR0(6)  # test execution timeout
-            self.timeout = (yield QueryTestTiming(a)).raw_value.as_integer
-            yield DTR0(0)  # next function test time high byte
-            x = (yield QueryTestTiming(a)).raw_value.as_integer
-            y = (yield QueryContentDTR1(a)).raw_value.as_integer
-            self.ft_delay = ((x << 8) + y) * 15
-            yield DTR0(2)  # next duration test time high byte
-            x = (yield QueryTestTiming(a)).raw_value.as_integer
-            y = (yield QueryContentDTR1(a)).raw_value.as_integer
-            self.dt_delay = ((x << 8) + y) * 15
+            # Read all the test timing values in a single network
+            # burst instead of one round-trip per frame
+            (_, ft_interval, _, dt_interval, _, timeout,
+             _, ft_hi, ft_lo, _, dt_hi, dt_lo) = yield [
+                DTR0(4), QueryTestTiming(a),  # function test interval
+                DTR0(5), QueryTestTiming(a),  # duration test interval
+                DTR0(6), QueryTestTiming(a),  # test execution timeout
+                DTR0(0), QueryTestTiming(a),  # next function test time
+                QueryContentDTR1(a),
+                DTR0(2), QueryTestTiming(a),  # next duration test time
+                QueryContentDTR1(a),
+            ]
+            self.ft_interval = ft_interval.raw_value.as_integer
+            self.dt_interval = dt_interval.raw_value.as_integer
+            self.timeout = timeout.raw_value.as_integer
+            self.ft_delay = ((ft_hi.raw_value.as_integer << 8)
+                             + ft_lo.raw_value.as_integer) * 15
+            self.dt_delay = ((dt_hi.raw_value.as_integer << 8)
+                             + dt_lo.raw_value.as_integer) * 15
 
 
 class Site:
@@ -343,41 +444,83 @@ class Site:
         self.name = d["name"]
         self.email_to = d["email-to"]
         self.email_from = d["email-from"]
-        self.buses = {k: Bus(v, key=k, site=self)
-                      for k, v in d["buses"].items()}
+        self._raw_buses = d["buses"]
+        self._raw_gear = d["gear"]
         self.expected_rated_duration = d.get("rated-duration", 180)
         self.expected_ft_interval = d.get("function-test-interval", 7)
         self.expected_dt_interval = d.get("duration-test_interval", 52)
         self.expected_timeout = d.get("test-execution-timeout", 7)
-        self.gear = [Gear(self, g) for g in d["gear"]]
-        self.gearindex = {(g.bus, g.address): g for g in self.gear}
         self.pass_ = False
         self.results = Counter()
+        self.report_time = None
+        self._report_cache = {}
 
-    def update(self, progress=None):
+    # Bus and Gear objects are built lazily so that commands that
+    # only need the configuration (eg. "list") don't pay for them
+    @cached_property
+    def buses(self):
+        return {k: Bus(v, key=k, site=self)
+                for k, v in self._raw_buses.items()}
+
+    @cached_property
+    def gear(self):
+        return [Gear(self, g) for g in self._raw_gear]
+
+    @cached_property
+    def gearindex(self):
+        return {(gear.bus, gear.address): gear for gear in self.gear}
+
+    def update(self, progress=None, rescan=False):
         self.report_time = datetime.datetime.now()
         self.pass_ = True
-        self.results = Counter()
+        self.results.clear()
+        self._report_cache.clear()
+        lock = threading.Lock()
+        results = self.results
+
+        def poll_bus(gear_on_bus):
+            # A bus connection is not thread-safe, so poll all the
+            # gear on a bus sequentially over a single connection.
+            bus = gear_on_bus[0].bus
+            with bus as b:
+                for gear in gear_on_bus:
+                    gear._update_on(b, rescan=rescan)
+                    summary = gear.summary
+                    with lock:
+                        results[summary] += 1
+                        if summary is not _PASS:
+                            self.pass_ = False
+                        if progress is not None:
+                            progress(gear)
+
+        buckets = {}
         for gear in self.gear:
-            gear.update()
-            self.results[gear.summary] += 1
-            if not gear.pass_:
-                self.pass_ = False
-            if progress is not None:
-                progress(gear)
+            buckets.setdefault(gear.bus, []).append(gear)
+        if not buckets:
+            return
+        with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+            futures = [executor.submit(poll_bus, gear_on_bus)
+                       for gear_on_bus in buckets.values()]
+            for future in as_completed(futures):
+                future.result()
 
     def report(self, sitename, template=None):
-        env = jinja2.Environment(
-            loader=jinja2.PackageLoader("emcon"),
-            autoescape=jinja2.select_autoescape())
-        template = env.get_template(template or "report.html")
-        return template.render(sitename=sitename, site=self)
-
-    def email_report(self, sitename, to=None):
+        template = template or "report.html"
+        key = (sitename, template, self.report_time)
+        rendered = self._report_cache.get(key)
+        if rendered is None:
+            rendered = _get_template(template).render(
+                sitename=sitename, site=self)
+            self._report_cache[key] = rendered
+        return rendered
+
+    def email_report(self, sitename, to=None, smtp=None):
+        import smtplib
+        from email.message import EmailMessage
         if to is None:
             to = ', '.join(self.email_to)
         report = self.report(sitename)
-        report_plain = html2text(report)
+        report_plain = self.report(sitename, template="report.txt")
         msg = EmailMessage()
         msg['Subject'] = f"{self.name} emergency lighting status — "\
             f"{'Pass' if self.pass_ else 'Fail'}"
@@ -388,12 +531,19 @@ class Site:
         msg.set_content(report_plain)
         msg.add_alternative(report, subtype="html")
 
-        with smtplib.SMTP() as smtp:
-            smtp.connect()
+        if smtp is not None:
             smtp.send_message(msg)
+        else:
+            with smtplib.SMTP() as smtp:
+                smtp.connect()
+                smtp.send_message(msg)
 
 
 def read_config(f):
-    d = tomli.load(f)
+    try:
+        import tomllib
+    except ImportError:
+        import tomli as tomllib
+    d = tomllib.load(f)
     for k, v in d.items():
         sites[k] = Site(v, key=k)